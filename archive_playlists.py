@@ -51,6 +51,9 @@ def _archive_playlists():
                 spotify_client.add_tracks_to_playlist(
                     list(chain.from_iterable(results.values())), recipe.target)
 
+            # Adds are buffered; make sure they all landed before the
+            # checkpoint moves past this collection.
+            spotify_client.flush()
             checkpoints[recipe_name] = recipe.source.checkpoint
         except Exception as e:
             print(e)
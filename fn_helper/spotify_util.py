@@ -1,13 +1,25 @@
+import atexit
+import json
+import os
 import re
 import shelve
+import threading
+import time
 from base64 import b64encode
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass
 from datetime import datetime, timedelta
-from urllib.parse import urlencode
+from functools import cached_property, wraps
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from pathlib import Path
+from urllib.parse import parse_qsl, urlencode, urlparse
 from uuid import uuid4
 
+import orjson
 import requests
-from flask import Flask, redirect, request
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 from .util import ElementIterator, chunk_gen, id_from_uri, is_uri
 from .config import config
@@ -28,13 +40,53 @@ def get_url(endpoint, **kwargs):
     return URLS[endpoint].format(**kwargs)
 
 
-@dataclass
+CACHE_DB = 'spotify_cache.db'
+TOKEN_PATH = Path('oauth2_token.json')
+
+
+def retry_rate_limited(request_func, max_retries=3):
+    """ Retries a request when Spotify answers 429, honoring Retry-After.
+        The mounted adapter only status-retries idempotent methods, so the
+        non-idempotent POST/PUT callers wrap themselves with this; a 429
+        means the request was rejected outright and is safe to replay.
+    """
+    @wraps(request_func)
+    def wrapper(*args, **kwargs):
+        for _ in range(max_retries):
+            resp = request_func(*args, **kwargs)
+            if resp.status_code != 429:
+                break
+            time.sleep(int(resp.headers.get('Retry-After', 1)))
+        return resp
+    return wrapper
+
+
+def _trigrams(text):
+    """ The set of 3-character windows of text.
+    """
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+
+def _cache_get(key):
+    with shelve.open(CACHE_DB) as cache:
+        return cache.get(key)
+
+
+def _cache_set(key, value):
+    with shelve.open(CACHE_DB) as cache:
+        cache[key] = value
+
+
+@dataclass(slots=True)
 class Track:
     id: str
     name: str
     submitted_by: str
     spotify_uri: str
-    raw_data: dict
+
+
+# Sentinel describing how to fetch a playlist's tracks on demand.
+_TrackFetchSpec = namedtuple('_TrackFetchSpec', 'parser track_url')
 
 
 @dataclass
@@ -42,45 +94,53 @@ class Playlist:
     id: str
     name: str
     _tracks: list
-    raw_data: dict
 
-    @property
+    @cached_property
     def tracks(self):
-        if isinstance(self._tracks, list):
+        if not isinstance(self._tracks, _TrackFetchSpec):
             return self._tracks
-        tracks = self._tracks['parser'](self._tracks['track_url'])
-        return list(map(self.parse_track, tracks))
+        tracks = self._tracks.parser(self._tracks.track_url)
+        return [self.parse_track(t) for t in tracks]
 
     def parse_track(self, track):
         return Track(id=track["track"]["id"],
                      name=track["track"]["name"],
                      submitted_by=track["added_by"]["id"],
-                     spotify_uri=track["track"]["uri"],
-                     raw_data=track)
+                     spotify_uri=track["track"]["uri"])
 
     def __str__(self):
         return self.name
 
 
+_NERD_PLAYLIST_MATCHER = re.compile(r"(\d{1,2}/\d{1,2} ?肥宅聽歌團)")
+_NERD_PLAYLIST_EXCLUDER = re.compile(r"[Rr]ound ?\d+")
+
+
 class SpotifyNerdPlaylistIterator(ElementIterator):
-    def __init__(self):
-        matcher = re.compile(r"(\d{1,2}/\d{1,2} ?肥宅聽歌團)")
-        excluder = re.compile(r"[Rr]ound ?\d+")
+
+    @cached_property
+    def elements(self):
+        """ Lazily builds the SpotifyClient and the playlist listing on
+            first iteration, so merely constructing the iterator (recipe
+            class bodies do this at import time) triggers no auth flow or
+            network calls.
+        """
         self.spotify_client = SpotifyClient()
         all_playlists = self.spotify_client.all_playlists()
-        matched = filter(lambda p: matcher.search(p['name']), all_playlists)
-        matched = filter(
-            lambda p: not bool(excluder.search(p['name'])), matched)
-        self.elements = list(map(self.parse_playlist, matched))
-        self.elements.reverse()
+        elements = [
+            self.parse_playlist(p) for p in all_playlists
+            if _NERD_PLAYLIST_MATCHER.search(p['name'])
+            and not _NERD_PLAYLIST_EXCLUDER.search(p['name'])]
+        elements.reverse()
+        return elements
 
     def parse_playlist(self, p):
         return Playlist(
             id=p['id'],
             name=p['name'],
-            _tracks={'parser': self.spotify_client.all_tracks_in_playlist,
-                     'track_url': p['id']},
-            raw_data=p)
+            _tracks=_TrackFetchSpec(
+                parser=self.spotify_client.all_tracks_in_playlist,
+                track_url=p['id']))
 
 
 class SpotifyAuthClient:
@@ -88,7 +148,7 @@ class SpotifyAuthClient:
         Use AuthClient().get_auth_header() to retrieve header for Http header.
     """
 
-    @property
+    @cached_property
     def _get_authorization_header(self):
         login = "{}:{}".format(config['APP_CLIENT_ID'],
                                config['APP_CLIENT_SECRET']).encode('ascii')
@@ -96,9 +156,35 @@ class SpotifyAuthClient:
             "Authorization": "Basic %s" % b64encode(login).decode('utf-8')
         }
 
+    def _load_token(self):
+        """ Loads the saved token attributes from the json token file,
+            deserializing expiry back to datetime and scope back to set.
+        """
+        if not TOKEN_PATH.exists():
+            return {}
+        token = json.loads(TOKEN_PATH.read_text())
+        if 'expiry' in token:
+            token['expiry'] = datetime.fromisoformat(token['expiry'])
+        if 'scope' in token:
+            token['scope'] = set(token['scope'])
+        return token
+
+    def _save_token(self):
+        """ Atomically writes the token attributes to the json token file
+            via a temp file and os.replace.
+        """
+        token = dict(self.token)
+        if 'expiry' in token:
+            token['expiry'] = token['expiry'].isoformat()
+        if 'scope' in token:
+            token['scope'] = sorted(token['scope'])
+        tmp_path = TOKEN_PATH.with_suffix('.tmp')
+        tmp_path.write_text(json.dumps(token))
+        os.replace(tmp_path, TOKEN_PATH)
+
     def _handle_token_response(self, token_response):
         """ Handle access_token and refresh access_token response and save
-            the attributes to shelve db.
+            the attributes to the token dict.
         """
         if not token_response.ok:
             raise ValueError(str(token_response.json()))
@@ -112,57 +198,72 @@ class SpotifyAuthClient:
         self.token['expiry'] = datetime.now() + timedelta(seconds=expires_in)
 
     def _run_oauth_client(self, session):
-        """ Run a Flask App to handle Spotify OAuth Callback.
+        """ Run a one-shot http.server to handle Spotify OAuth Callback.
         """
-        app = Flask('OAuth Client')
+        auth_client = self
         host = config['OAUTH_CLIENT_HOST']
         port = config['OAUTH_CLIENT_PORT']
         redirect_uri = f"http://{host}:{port}/callback"
 
-        @app.route('/auth')
-        def authorization_code():
-            """ Redirects /auth to the authorization code webpage.
-            """
-            params = {
-                'client_id': config['APP_CLIENT_ID'],
-                'response_type': "code",
-                'redirect_uri': redirect_uri,
-                'state': session.session_id,
-                'scope': ' '.join(config['SCOPE'])
-            }
-            return redirect('{}?{}'.format(get_url('auth'), urlencode(params)))
-
-        @app.route('/callback')
-        def callback():
-            """ Handles authorization code callback and later calls
-                access_token get.
-            """
-            error = request.args.get('error')
-            if error:
-                raise ValueError(error)
-
-            auth_code = request.args.get('code')
-
-            token_request_body = {
-                'grant_type': "authorization_code",
-                'code': auth_code,
-                'redirect_uri': redirect_uri
-            }
-            token_response = session.post(
-                get_url('token'), data=token_request_body,
-                headers=self._get_authorization_header)
-            self._handle_token_response(token_response)
-            shutdown = request.environ.get('werkzeug.server.shutdown')
-            if not shutdown:
-                raise RuntimeError("Access code succesfully retrieved.")
-            shutdown()
-            return 'Well, hello there!'
-
-        app.run(host=host, port=port)
+        class OAuthRequestHandler(BaseHTTPRequestHandler):
+
+            def _redirect_to_authorization(self):
+                """ Redirects /auth to the authorization code webpage.
+                """
+                params = {
+                    'client_id': config['APP_CLIENT_ID'],
+                    'response_type': "code",
+                    'redirect_uri': redirect_uri,
+                    'state': session.session_id,
+                    'scope': ' '.join(config['SCOPE'])
+                }
+                self.send_response(302)
+                self.send_header('Location', '{}?{}'.format(
+                    get_url('auth'), urlencode(params)))
+                self.end_headers()
+
+            def _handle_callback(self, args):
+                """ Handles authorization code callback and later calls
+                    access_token get.
+                """
+                error = args.get('error')
+                if error:
+                    self.send_error(400, explain=error)
+                    return
+
+                token_request_body = {
+                    'grant_type': "authorization_code",
+                    'code': args.get('code'),
+                    'redirect_uri': redirect_uri
+                }
+                token_response = session.post(
+                    get_url('token'), data=token_request_body,
+                    headers=auth_client._get_authorization_header)
+                auth_client._handle_token_response(token_response)
+                self.send_response(200)
+                self.send_header('Content-Type', "text/plain")
+                self.end_headers()
+                self.wfile.write(b'Well, hello there!')
+                # shutdown() blocks until serve_forever returns, so it has
+                # to run from another thread.
+                threading.Thread(target=self.server.shutdown).start()
+
+            def do_GET(self):
+                parsed = urlparse(self.path)
+                if parsed.path == '/auth':
+                    self._redirect_to_authorization()
+                elif parsed.path == '/callback':
+                    self._handle_callback(dict(parse_qsl(parsed.query)))
+                else:
+                    self.send_error(404)
+
+        server = HTTPServer((host, port), OAuthRequestHandler)
+        server.serve_forever()
+        server.server_close()
 
     def _refresh_access_token(self, session):
         """ Refreshes access_token and saves the new access_token,
-            refresh_token, expiry to shelve db.
+            refresh_token, expiry to the token dict.
         """
         token_request_body = {
             'grant_type': "refresh_token",
@@ -190,7 +291,7 @@ class SpotifyAuthClient:
 
     def __init__(self):
         try:
-            self.token = shelve.open('oauth2_token.db', writeback=True)
+            self.token = self._load_token()
             auth_session = requests.Session()
             auth_session.session_id = uuid4().hex
             if not self.token.get('access_token'):
@@ -199,35 +300,131 @@ class SpotifyAuthClient:
                 self._refresh_access_token(auth_session)
             self.access_token = self.token['access_token']
         finally:
-            self.token.sync()
-            self.token.close()
+            self._save_token()
             delattr(self, 'token')
 
 
 class SpotifyClient:
+    _FLUSH_BATCH = 100
+    _FLUSH_INTERVAL = 0.5
+
     def handle_request(self, method, *args, **kwargs):
         """ Handles HTTP response erros.
             TODO: Better handler
         """
         resp = method(*args, **kwargs)
-        result = resp.json()
+        return self.handle_response(resp)
+
+    def handle_response(self, resp):
+        result = orjson.loads(resp.content)
         if not resp.ok:
             raise ValueError(str(result))
         return result
 
-    def paginate_through(self, url, params=None):
-        """ Paginates through a paginated object listing with the starter url.
+    def _iter_pages(self, url, params, resp):
+        """ Yields each page of a paging object starting from its first
+            page. Once the first page reveals the collection size, the
+            remaining pages are fetched concurrently by offset instead of
+            chasing `next` links one round trip at a time.
+        """
+        yield resp
+
+        total = resp.get('total')
+        limit = resp.get('limit')
+        if total and limit:
+            offsets = range(
+                resp.get('offset', 0) + limit, total, limit)
+            with ThreadPoolExecutor(max_workers=8) as executor:
+                futures = [
+                    executor.submit(
+                        self.handle_request, self.spotify_session.get, url,
+                        params={**params, 'offset': offset, 'limit': limit})
+                    for offset in offsets]
+                for future in futures:
+                    yield future.result()
+        else:
+            # Paging object without `total`, fall back to chasing `next`.
+            url = resp.get('next')
+            while url:
+                resp = self.handle_request(
+                    self.spotify_session.get, url, params=params)
+                yield resp
+                url = resp.get('next')
+
+    def iter_paginate(self, url, params=None):
+        """ Lazily yields the items of a paginated object listing, one page
+            in memory at a time.
         """
-        results = []
         if params is None:
             params = {'limit': 50}
-        while url:
-            resp = self.handle_request(
-                self.spotify_session.get, url, params=params)
-            results.extend(resp['items'])
-            url = resp.get('next')
+        resp = self.handle_request(
+            self.spotify_session.get, url, params=params)
+        for page in self._iter_pages(url, params, resp):
+            yield from page['items']
+
+    def paginate_through(self, url, params=None):
+        """ Paginates through a paginated object listing with the starter
+            url and returns all items as a list.
+        """
+        return list(self.iter_paginate(url, params))
+
+    def _paginate_from(self, url, params, resp):
+        """ Collects the rest of a paging object given its first page,
+            pre-sizing the result list when the total is known to avoid
+            repeated growth reallocations.
+        """
+        pages = self._iter_pages(url, params, resp)
+        total = resp.get('total')
+        if not total:
+            results = []
+            for page in pages:
+                results.extend(page['items'])
+            return results
+
+        results = [None] * total
+        idx = 0
+        for page in pages:
+            items = page['items']
+            results[idx:idx + len(items)] = items
+            idx += len(items)
+        del results[idx:]
         return results
 
+    @cached_property
+    def _name_index(self):
+        """ Lowercased (name, id) pairs of the user's playlists, built once
+            per client for name lookups.
+        """
+        return [(p['name'].lower(), p['id']) for p in self.all_playlists()]
+
+    @cached_property
+    def _trigram_index(self):
+        """ Maps each trigram of the lowercased playlist names to the
+            _name_index positions containing it.
+        """
+        index = {}
+        for pos, (name, _) in enumerate(self._name_index):
+            for trigram in _trigrams(name):
+                index.setdefault(trigram, set()).add(pos)
+        return index
+
+    def _name_candidates(self, needle):
+        """ Narrows _name_index down to entries sharing every trigram of
+            the needle; needles shorter than a trigram fall back to the
+            full list.
+        """
+        if len(needle) < 3:
+            return self._name_index
+        candidates = None
+        for trigram in _trigrams(needle):
+            positions = self._trigram_index.get(trigram)
+            if not positions:
+                return []
+            candidates = (positions if candidates is None
+                          else candidates & positions)
+        # Keep library order so ties resolve like the old linear scan.
+        return [self._name_index[pos] for pos in sorted(candidates)]
+
     def get_playlist_id(self, playlist):
         """ Retrieve a playlist by its URI or its name
         """
@@ -236,34 +433,171 @@ class SpotifyClient:
             playlist_id = id_from_uri(playlist)
         # If in name format
         else:
-            all_playlists = self.all_playlists()
-            matched = next(
-                filter(lambda p: playlist in p['name'], all_playlists), {})
-            playlist_id = matched.get('id')
+            needle = playlist.lower()
+            playlist_id = next(
+                (p_id for name, p_id in self._name_candidates(needle)
+                 if needle in name),
+                None)
         if not playlist_id:
             raise ValueError("No matching playlist found.")
         return playlist_id
 
     def all_playlists(self):
-        return self.paginate_through(get_url('playlists'))
+        """ Lists the user's playlists, revalidating a cached copy with
+            If-None-Match so an unchanged library costs one conditional GET
+            instead of a full pagination sweep.
+        """
+        url = get_url('playlists')
+        # Project away the bulk of the playlist objects; only the paging
+        # fields and what parse_playlist/get_playlist_id read survive.
+        params = {'limit': 50,
+                  'fields': "items(id,name),next,total,limit,offset"}
+        cached = _cache_get('playlists')
+        headers = {'If-None-Match': cached['etag']} if cached else {}
+        resp = self.spotify_session.get(url, params=params, headers=headers)
+        if resp.status_code == 304:
+            return cached['items']
+        playlists = self._paginate_from(
+            url, params, self.handle_response(resp))
+        etag = resp.headers.get('ETag')
+        if etag:
+            _cache_set('playlists', {'etag': etag, 'items': playlists})
+        return playlists
 
     def all_tracks_in_playlist(self, playlist_id):
-        return self.paginate_through(
+        """ Lists a playlist's tracks, cached by (playlist_id, snapshot_id)
+            so an unchanged playlist costs one cheap snapshot probe instead
+            of a pagination sweep.
+        """
+        snapshot_id = self.handle_request(
+            self.spotify_session.get,
+            get_url('playlist', playlist_id=playlist_id),
+            params={'fields': 'snapshot_id'})['snapshot_id']
+        cache_key = 'tracks:{}'.format(playlist_id)
+        cached = _cache_get(cache_key)
+        if cached and cached[0] == snapshot_id:
+            return cached[1]
+        tracks = list(self.iter_paginate(
             get_url('tracks', playlist_id=playlist_id),
-            params={'offset': 0, 'limit': 100})
+            params={'offset': 0, 'limit': 100,
+                    'fields': ("items(added_by.id,track(id,name,uri)),"
+                               "next,total,limit,offset")}))
+        # One entry per playlist; a new snapshot overwrites the old copy
+        # instead of piling up stale ones.
+        _cache_set(cache_key, (snapshot_id, tracks))
+        return tracks
 
     def add_tracks_to_playlist(self, tracks, playlist_id):
-        for chunk in chunk_gen(tracks):
-            self.handle_request(
-                self.spotify_session.post,
-                get_url('tracks', playlist_id=playlist_id),
-                json={'uris': chunk})
+        """ Buffers the adds and lets the background worker coalesce them
+            into full 100-track POSTs. Callers that add a handful of tracks
+            at a time no longer pay a round trip each; call flush() (also
+            registered atexit) to force everything out.
+        """
+        with self._pending_lock:
+            pending = self._pending_adds.setdefault(playlist_id, [])
+            pending.extend(tracks)
+            batch_ready = len(pending) >= self._FLUSH_BATCH
+        if batch_ready:
+            self._flush_signal.set()
+
+    def _post_tracks(self, tracks, playlist_id):
+        """ POSTs tracks in concurrent 100-track chunks and returns a list
+            of (chunk, error) for the chunks that failed, so callers can
+            decide per chunk whether a replay is safe.
+        """
+        url = get_url('tracks', playlist_id=playlist_id)
+        chunks = list(chunk_gen(tracks))
+        failures = []
+        with ThreadPoolExecutor(max_workers=5) as executor:
+            futures = [
+                executor.submit(
+                    self.handle_request,
+                    retry_rate_limited(self.spotify_session.post), url,
+                    data=orjson.dumps({'uris': chunk}))
+                for chunk in chunks]
+            for chunk, future in zip(chunks, futures):
+                try:
+                    future.result()
+                except Exception as e:
+                    failures.append((chunk, e))
+        return failures
+
+    def _drain_pending(self):
+        """ Posts every buffered track add. Drains are mutually exclusive
+            via the drain lock, so a caller entering here waits for any
+            in-flight background batch to finish first. Chunks that never
+            reached the server go back in the buffer for the next drain;
+            chunks that died with an HTTP error may already have been
+            applied server-side, so they are never replayed - they are
+            parked and surfaced by the next flush().
+        """
+        with self._drain_lock:
+            with self._pending_lock:
+                pending, self._pending_adds = self._pending_adds, {}
+            for playlist_id, uris in pending.items():
+                for chunk, error in self._post_tracks(uris, playlist_id):
+                    if isinstance(error, requests.ConnectionError):
+                        with self._pending_lock:
+                            self._pending_adds[playlist_id] = (
+                                chunk
+                                + self._pending_adds.get(playlist_id, []))
+                    else:
+                        print(error)
+                        with self._pending_lock:
+                            self._failed_adds.append(
+                                (playlist_id, chunk, error))
+
+    def _flush_worker(self):
+        while True:
+            self._flush_signal.wait(self._FLUSH_INTERVAL)
+            self._flush_signal.clear()
+            self._drain_pending()
+
+    def flush(self):
+        """ Synchronously posts every buffered track add, waiting out any
+            in-flight background batch, and raises if any chunk failed
+            since the last flush.
+        """
+        self._drain_pending()
+        with self._pending_lock:
+            failed, self._failed_adds = self._failed_adds, []
+        if failed:
+            raise ValueError(
+                "%d track add chunk(s) failed: %s" % (
+                    len(failed),
+                    '; '.join(str(error) for _, _, error in failed)))
 
     def update_playlist_tracks(self, playlist_id, **data):
         return self.handle_request(
-            self.spotify_session.put,
-            get_url('tracks', playlist_id=playlist_id), json=data)
+            retry_rate_limited(self.spotify_session.put),
+            get_url('tracks', playlist_id=playlist_id),
+            data=orjson.dumps(data))
 
     def __init__(self):
         self.spotify_session = requests.Session()
         self.spotify_session.headers = SpotifyAuthClient().get_auth_header()
+        self.spotify_session.headers['Content-Type'] = 'application/json'
+        self.spotify_session.headers['Accept-Encoding'] = 'gzip'
+        # One pool large enough for the pagination and upload executors
+        # combined, so every worker reuses a warm TLS connection instead
+        # of handshaking its own. Status retries are limited to read-only
+        # methods: a 5xx may mean the server already applied a track POST
+        # or a reorder PUT, and replaying either would duplicate adds or
+        # double-move tracks. Writes get their own 429-only retry via
+        # retry_rate_limited.
+        self.spotify_session.mount(
+            'https://', HTTPAdapter(
+                pool_connections=20, pool_maxsize=20,
+                max_retries=Retry(
+                    total=3, backoff_factor=0.3,
+                    status_forcelist=[429, 500, 502, 503, 504],
+                    allowed_methods=frozenset({'HEAD', 'GET', 'OPTIONS'}),
+                    respect_retry_after_header=True)))
+
+        self._pending_adds = {}
+        self._failed_adds = []
+        self._pending_lock = threading.Lock()
+        self._drain_lock = threading.Lock()
+        self._flush_signal = threading.Event()
+        threading.Thread(target=self._flush_worker, daemon=True).start()
+        atexit.register(self.flush)
@@ -12,7 +12,7 @@ def _shuffle_playlist(playlist):
     spotify_client = SpotifyClient()
     playlist_id = spotify_client.get_playlist_id(playlist)
 
-    tracks = spotify_client.all_tracks_in_playlist(playlist_id)
+    tracks = list(spotify_client.all_tracks_in_playlist(playlist_id))
     track_order = [t['track']['id'] for t in tracks if t]
     new_track_order = [t['track']['id'] for t in tracks if t]
     random.shuffle(new_track_order)